@@ -1,21 +1,34 @@
-import openai
 import os
-import json
-import pdfplumber
+import orjson
+import io
+import re
+import uuid
+import time
+import hashlib
+import threading
+import copy
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import streamlit as st
-from dotenv import load_dotenv
 from datetime import datetime
-
-# Load environment variables
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from itertools import chain
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 # File paths
 OUTPUT_DIR = "outputs"
-LEDGER_FILE = os.path.join(OUTPUT_DIR, "ledger.xlsx")
+LEDGER_DIR = os.path.join(OUTPUT_DIR, "ledger")
+LEDGER_COUNTER_FILE = os.path.join(LEDGER_DIR, "_counter.txt")
+LEGACY_LEDGER_FILES = [os.path.join(OUTPUT_DIR, "ledger.parquet"), os.path.join(OUTPUT_DIR, "ledger.xlsx")]
 INVENTORY_FILE = os.path.join(OUTPUT_DIR, "inventory.xlsx")
+CACHE_DIR = os.path.join(OUTPUT_DIR, "_cache")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Excel engines: Rust-backed calamine for reads, streaming xlsxwriter for writes
+EXCEL_READ_ENGINE = "calamine"
+EXCEL_WRITE_ENGINE = "xlsxwriter"
 
 # Hardcoded vendor-to-category map
 VENDOR_CATEGORY_MAP = {
@@ -24,6 +37,558 @@ VENDOR_CATEGORY_MAP = {
     "Staples": "Office Supplies"
 }
 
+# Ledger storage: an append-only Parquet dataset under outputs/ledger/. Each
+# save writes one part file and bumps _counter.txt, which holds the last sr_no.
+# Saves go straight from column lists to pyarrow; pandas is only used to read.
+LEDGER_TEXT_COLUMNS = ["date", "reference", "description"]
+LEDGER_AMOUNT_COLUMNS = ["debit", "credit"]
+LEDGER_SCHEMA = pa.schema([
+    ("sr_no", pa.int64()),
+    ("date", pa.string()),
+    ("reference", pa.string()),
+    ("description", pa.string()),
+    ("debit", pa.float64()),
+    ("credit", pa.float64())
+])
+
+def _ledger_parts():
+    if not os.path.isdir(LEDGER_DIR):
+        return []
+    return sorted(f for f in os.listdir(LEDGER_DIR) if f.startswith("part-") and f.endswith(".parquet"))
+
+def _load_legacy_ledger():
+    for path in LEGACY_LEDGER_FILES:
+        if os.path.exists(path):
+            return pd.read_parquet(path) if path.endswith(".parquet") else pd.read_excel(path, engine=EXCEL_READ_ENGINE)
+    return None
+
+def _last_sr_no(df):
+    if "sr_no" not in df:
+        return 0
+    last = pd.to_numeric(df["sr_no"], errors="coerce").max()
+    return 0 if pd.isna(last) else int(last)
+
+def _read_counter():
+    if os.path.exists(LEDGER_COUNTER_FILE):
+        with open(LEDGER_COUNTER_FILE, "r") as f:
+            raw = f.read().strip()
+        if raw.isdigit():
+            return int(raw)
+    # Missing or unreadable counter: recover it from the parts' sr_no column only
+    if _ledger_parts():
+        last = pc.max(pq.read_table(LEDGER_DIR, columns=["sr_no"]).column("sr_no")).as_py()
+        return last or 0
+    return 0
+
+def _write_counter(value):
+    # Write-then-rename so a crash never leaves a truncated counter behind
+    tmp_path = f"{LEDGER_COUNTER_FILE}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(value))
+    os.replace(tmp_path, LEDGER_COUNTER_FILE)
+
+def _ledger_table(columns):
+    columns = dict(columns)
+    for col in LEDGER_TEXT_COLUMNS:
+        columns[col] = [None if value is None else str(value) for value in columns[col]]
+    for col in LEDGER_AMOUNT_COLUMNS:
+        columns[col] = [None if value in (None, "") else float(value) for value in columns[col]]
+    return pa.Table.from_pydict(columns, schema=LEDGER_SCHEMA)
+
+def _number_legacy_ledger(df):
+    # Old ledgers (e.g. data/ledger.xlsx) may lack sr_no or leave it blank
+    df = df.reindex(columns=LEDGER_SCHEMA.names)
+    sr_no = pd.to_numeric(df["sr_no"], errors="coerce")
+    if sr_no.isna().any():
+        sr_no = pd.Series(range(1, len(df) + 1), index=df.index)
+    df["sr_no"] = sr_no.astype("Int64")
+    return df
+
+def _legacy_ledger_table(df):
+    df = df.copy()
+    for col in LEDGER_TEXT_COLUMNS:
+        df[col] = df[col].astype("string")
+    for col in LEDGER_AMOUNT_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+    return pa.Table.from_pandas(df[LEDGER_SCHEMA.names], schema=LEDGER_SCHEMA, preserve_index=False)
+
+def _write_ledger_part(table, start):
+    # Zero-padded start keeps parts in sr_no order; the uuid keeps names unique
+    suffix = f"{start:010d}-{uuid.uuid4().hex[:8]}.parquet"
+    # Write under an underscore name (skipped by pyarrow's dataset reader), then
+    # rename, so readers and crashes never see a half-written part
+    tmp_path = os.path.join(LEDGER_DIR, f"_tmp-{suffix}")
+    pq.write_table(table, tmp_path, compression="snappy")
+    os.replace(tmp_path, os.path.join(LEDGER_DIR, f"part-{suffix}"))
+
+def load_ledger():
+    if _ledger_parts():
+        return pd.read_parquet(LEDGER_DIR)
+    return _load_legacy_ledger()
+
+# One lock per process, shared by every session, around counter read-and-bump
+@st.cache_resource(show_spinner=False)
+def _ledger_lock():
+    return threading.Lock()
+
+def append_ledger(columns):
+    os.makedirs(LEDGER_DIR, exist_ok=True)
+
+    with _ledger_lock():
+        # First save after upgrading: carry the old single-file ledger over as part one
+        if not _ledger_parts():
+            legacy = _load_legacy_ledger()
+            if legacy is not None and not legacy.empty:
+                legacy = _number_legacy_ledger(legacy)
+                legacy_table = _legacy_ledger_table(legacy)
+                _write_counter(_last_sr_no(legacy))
+                _write_ledger_part(legacy_table, 1)
+
+        # Build the table first so a bad value fails before any sr_no is used up.
+        # Then reserve the range before writing the part: a crash in between
+        # leaves a gap in the numbering rather than reusing numbers.
+        counter = _read_counter()
+        row_count = len(columns["date"])
+        columns = {"sr_no": list(range(counter + 1, counter + row_count + 1)), **columns}
+        table = _ledger_table(columns)
+        _write_counter(counter + row_count)
+        _write_ledger_part(table, counter + 1)
+
+@st.cache_data(show_spinner=False)
+def ledger_to_xlsx(df):
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False, engine=EXCEL_WRITE_ENGINE)
+    return buffer.getvalue()
+
+# PDF text extraction
+@st.cache_data(show_spinner=False)
+def extract_pdf_pages(pdf_bytes):
+    import fitz
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        parts = []
+        for page in doc:
+            page_text = page.get_text("text").strip()
+            if page_text:
+                parts.append(page_text)
+    finally:
+        doc.close()
+    return parts
+
+# Prompt text budget. Long invoices keep the first page (vendor, number, date)
+# plus any page with a monetary amount, dropping terms-and-conditions pages.
+PROMPT_MAX_CHARS = 8000
+MONEY_PATTERN = re.compile(r"\$?\d+[.,]\d{2}")
+
+def compact_invoice_text(pages, max_chars=PROMPT_MAX_CHARS):
+    pages = [re.sub(r"\n{3,}", "\n\n", re.sub(r"[ \t]+", " ", page)) for page in pages]
+    if sum(len(page) for page in pages) > max_chars:
+        pages = [page for idx, page in enumerate(pages) if idx == 0 or MONEY_PATTERN.search(page)]
+    return "\n".join(pages)[:max_chars]
+
+# GPT prompts. The static instructions go in the system message ahead of the
+# invoice text, so every call starts with the same prefix.
+GPT_MODEL = "gpt-4o-mini"
+
+# Extraction and category suggestion share one call: the response carries the
+# invoice fields under "invoice" and the debit category under "category". The
+# extraction prompt is deliberately kept above the 1024-token minimum that
+# OpenAI's automatic prompt caching requires, so the shared prefix can be reused.
+STATIC_EXTRACTION_PROMPT = """
+You are an accounts-payable assistant. From the invoice text supplied by the
+user, extract the invoice fields and suggest the accounting category to debit.
+The text was extracted from a PDF, so columns may be run together, headers and
+footers may repeat on every page, and labels may be separated from their values.
+
+Invoice fields:
+
+- invoice_number: the invoice or bill number exactly as printed, including any
+  prefix such as "INV-" or "#". Do not use a purchase order number, customer
+  account number, or order number unless no invoice number is present.
+- invoice_date: the issue date, formatted as YYYY-MM-DD. Prefer the "Invoice
+  Date" or "Date of Issue" over the due date, ship date, or order date.
+- vendor_name: the business that issued the invoice, usually in the letterhead
+  or next to "From" / "Remit to". Never the "Bill to" or "Ship to" customer.
+- line_items: list of objects with description, quantity, and amount.
+- subtotal: amount before taxes.
+- taxes: total tax charged, summing every tax line (sales tax, VAT, GST, HST).
+- total_amount: the final amount due, after discounts, shipping, and taxes.
+- contact_info: object with the vendor's address and phone_number.
+
+Rules for amounts:
+- Amounts are plain numbers without currency symbols or thousands separators,
+  for example 1234.5 rather than "$1,234.50".
+- When an amount uses a comma as the decimal separator (for example "1.234,50"
+  on a European invoice), convert it to 1234.5.
+- Credits, refunds, and discounts are negative numbers.
+- If the invoice shows both "Total" and "Balance Due" and they differ because of
+  a prior payment, use the invoice total, not the remaining balance.
+- Use 0 for any missing amount. Never guess an amount that is not printed.
+
+Rules for line items:
+- Each line item has description, quantity, and amount.
+- quantity is a whole number; use 1 when the invoice does not state one, such
+  as for a monthly subscription or a single service fee.
+- amount on a line item is the line total (quantity times unit price), not the
+  unit price. If only the unit price and quantity are printed, multiply them.
+- Shipping, freight, handling, and delivery charges are line items with the
+  description as printed and quantity 1.
+- A discount printed as its own line is a line item with a negative amount.
+- Lines that only repeat a header, a page number, a running subtotal, or a
+  "continued" marker are not line items.
+- Do not invent line items that are not on the invoice, and do not merge
+  separate lines that share a description.
+- Keep the description short: the product or service name plus any size,
+  model, or period that distinguishes it, without SKU or barcode numbers.
+
+Rules for text fields:
+- Use an empty string for any text field that is missing.
+- Keep address lines in printed order, joined with ", ".
+- phone_number is the vendor's phone number as printed; ignore fax numbers and
+  the customer's phone number.
+- Dates written as "03/04/2024" are ambiguous; use the vendor's country (from
+  the address or currency) to decide day-first or month-first, defaulting to
+  month-first for US vendors.
+
+Rules for multi-page invoices and unusual documents:
+- Header fields (invoice number, date, vendor) usually appear on the first
+  page; ignore copies repeated in page headers on later pages.
+- When line items continue across pages, include every line exactly once; a
+  "carried forward" or "brought forward" total is not a line item.
+- The totals block (subtotal, taxes, total) is usually on the last page.
+- A credit note or credit memo is extracted like an invoice, but its line item
+  amounts, subtotal, taxes, and total_amount are negative.
+- A statement of account that lists several invoices is not an invoice: use the
+  most recent invoice number and date shown, and its amount as total_amount.
+- If the text contains no invoice at all, return the "invoice" object with
+  empty strings, an empty line_items list, and zero amounts.
+
+Category: an accounting category like 'Office Supplies', 'IT Services', or
+'Inventory Purchases'. Use 'Inventory Purchases' only for goods bought for
+resale or stock. Other common categories are 'Utilities', 'Rent',
+'Professional Fees', 'Travel', 'Meals and Entertainment', 'Advertising',
+'Repairs and Maintenance', 'Shipping and Postage', and 'Insurance'. Choose the
+single category that covers most of the invoice total.
+
+Only return a valid JSON object with "invoice" and "category" keys. Example of
+a simple goods invoice:
+
+{
+  "invoice": {
+    "invoice_number": "INV-1042",
+    "invoice_date": "2024-03-15",
+    "vendor_name": "Staples",
+    "line_items": [
+      {"description": "Printer paper, A4, 500 sheets", "quantity": 10, "amount": 54.90},
+      {"description": "Black ink cartridge", "quantity": 2, "amount": 61.98}
+    ],
+    "subtotal": 116.88,
+    "taxes": 9.35,
+    "total_amount": 126.23,
+    "contact_info": {"address": "500 Staples Dr, Framingham, MA 01702", "phone_number": "800-378-2753"}
+  },
+  "category": "Office Supplies"
+}
+
+Example of a service invoice with a discount, shipping, and no phone number:
+
+{
+  "invoice": {
+    "invoice_number": "2024-0387",
+    "invoice_date": "2024-06-01",
+    "vendor_name": "Northwind Cloud Ltd",
+    "line_items": [
+      {"description": "Managed hosting, June 2024", "quantity": 1, "amount": 450.00},
+      {"description": "Additional storage, 500 GB", "quantity": 2, "amount": 80.00},
+      {"description": "Loyalty discount", "quantity": 1, "amount": -53.00},
+      {"description": "Hardware token shipping", "quantity": 1, "amount": 12.50}
+    ],
+    "subtotal": 489.50,
+    "taxes": 97.90,
+    "total_amount": 587.40,
+    "contact_info": {"address": "12 Harbour Street, Leeds, LS1 4AB, United Kingdom", "phone_number": ""}
+  },
+  "category": "IT Services"
+}
+
+Example of a credit note for returned stock:
+
+{
+  "invoice": {
+    "invoice_number": "CN-00219",
+    "invoice_date": "2024-07-22",
+    "vendor_name": "ABCD Wholesale Inc",
+    "line_items": [
+      {"description": "Returned: steel shelving unit, 5-tier", "quantity": 3, "amount": -357.00}
+    ],
+    "subtotal": -357.00,
+    "taxes": -28.56,
+    "total_amount": -385.56,
+    "contact_info": {"address": "88 Industrial Pkwy, Dayton, OH 45402", "phone_number": "937-555-0142"}
+  },
+  "category": "Inventory Purchases"
+}
+"""
+
+# Used on its own only when the combined extraction did not yield a category.
+# Too short for prompt caching; it is a rare fallback, so that is accepted.
+STATIC_CATEGORY_PROMPT = """
+You are an accounts-payable assistant. Suggest the accounting category to
+debit for the invoice text supplied by the user, for example 'Office Supplies',
+'IT Services', or 'Inventory Purchases'. Use 'Inventory Purchases' only for
+goods bought for resale or stock.
+
+Only return a valid JSON object of the form {"category": "<category name>"}.
+"""
+
+# GPT response cache (in process via st.cache_resource, on disk under outputs/_cache).
+# Not st.cache_data: the GPT helpers stream to the page on a miss, and cache_data
+# would record and replay every streamed update on each hit.
+# The key covers the model and system prompt too, so changing either one
+# invalidates earlier answers instead of serving them from disk.
+def _cache_path(kind, prompt, text):
+    payload = "\0".join([GPT_MODEL, prompt, text])
+    key = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{kind}-{key}.json")
+
+def _read_cache(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def _write_cache(path, value):
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(value))
+
+@st.cache_resource(show_spinner=False)
+def _gpt_memory_cache():
+    return {}
+
+# Callers edit the returned data in place, so hand out copies
+def _cache_get(path):
+    memory = _gpt_memory_cache()
+    if path not in memory:
+        value = _read_cache(path)
+        if value is None:
+            return None
+        memory[path] = value
+    return copy.deepcopy(memory[path])
+
+def _cache_put(path, value):
+    _gpt_memory_cache()[path] = copy.deepcopy(value)
+    _write_cache(path, value)
+
+# openai and python-dotenv load on the first GPT call rather than at startup.
+# st.cache_resource (not lru_cache) so this survives Streamlit's script reruns.
+@st.cache_resource(show_spinner=False)
+def _get_openai():
+    import openai
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    return openai
+
+# Retry transient OpenAI failures with exponential backoff. An exhausted quota
+# also comes back as a 429 but will not clear by waiting, so it is not retried.
+def is_quota_error(e):
+    if not isinstance(e, _get_openai().error.RateLimitError):
+        return False
+    body = e.json_body if isinstance(e.json_body, dict) else {}
+    return (body.get("error") or {}).get("code") == "insufficient_quota"
+
+def _is_transient_error(e):
+    error = _get_openai().error
+    transient = (
+        error.RateLimitError,
+        error.APIError,
+        error.Timeout,
+        error.APIConnectionError,
+        error.ServiceUnavailableError,
+        error.TryAgain
+    )
+    return isinstance(e, transient) and not is_quota_error(e)
+
+# Process-wide guard shared by every session: at most GPT_MAX_CONCURRENCY calls
+# in flight and at least GPT_MIN_INTERVAL seconds between request starts.
+GPT_MAX_CONCURRENCY = 4
+GPT_MIN_INTERVAL = 0.5
+
+class _RateLimiter:
+    def __init__(self, max_concurrency, min_interval):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._min_interval = min_interval
+        self._next_slot = time.monotonic()
+
+    def wait_for_slot(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._next_slot - now)
+            self._next_slot = max(now, self._next_slot) + self._min_interval
+        if wait:
+            time.sleep(wait)
+
+@st.cache_resource(show_spinner=False)
+def _gpt_limiter():
+    return _RateLimiter(GPT_MAX_CONCURRENCY, GPT_MIN_INTERVAL)
+
+def call_gpt(**kwargs):
+    _gpt_limiter().wait_for_slot()
+    return _get_openai().ChatCompletion.create(**kwargs)
+
+# Stream a chat completion into a temporary placeholder and return the full text.
+# The retry wraps opening *and* consuming the stream, so a transient error
+# mid-stream starts a fresh attempt with an empty buffer and placeholder.
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=1, max=30),
+    retry=retry_if_exception(_is_transient_error),
+    reraise=True
+)
+def stream_gpt(**kwargs):
+    # Hold a concurrency slot until the stream is fully consumed
+    with _gpt_limiter().semaphore:
+        return _consume_stream(call_gpt(stream=True, **kwargs))
+
+def _consume_stream(response):
+    buf = []
+
+    def tokens():
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.get("content", "")
+            if piece:
+                buf.append(piece)
+                yield piece
+
+    placeholder = st.empty()
+    try:
+        with placeholder.container():
+            st.write_stream(tokens())
+    finally:
+        placeholder.empty()
+    return "".join(buf)
+
+INVOICE_FIELDS = {"invoice_number", "invoice_date", "vendor_name", "line_items", "subtotal", "taxes", "total_amount", "contact_info"}
+
+def gpt_extract(text):
+    path = _cache_path("invoice", STATIC_EXTRACTION_PROMPT, text)
+    cached = _cache_get(path)
+    if cached is not None:
+        return cached
+
+    result = stream_gpt(
+        model=GPT_MODEL,
+        messages=[
+            {"role": "system", "content": STATIC_EXTRACTION_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0
+    )
+    response = orjson.loads(result)
+    data = response.get("invoice")
+    if not isinstance(data, dict):
+        # Accept the flat schema too; anything else raises before it is cached
+        if not INVOICE_FIELDS & response.keys():
+            raise ValueError("GPT response has no invoice fields")
+        data = {key: value for key, value in response.items() if key != "category"}
+
+    for item in data.get("line_items", []):
+        amt = str(item.get("amount", 0)).replace("$", "").replace(",", "")
+        item["amount"] = float(amt or 0)
+        item["quantity"] = int(item.get("quantity") or 1)
+        item["unit_cost"] = round(item["amount"] / item["quantity"], 2) if item["quantity"] != 0 else 0
+
+    extraction = {"invoice": data, "category": str(response.get("category") or "").strip()}
+    _cache_put(path, extraction)
+    return extraction
+
+def suggest_category(text):
+    path = _cache_path("category", STATIC_CATEGORY_PROMPT, text)
+    cached = _cache_get(path)
+    if cached is not None:
+        return cached
+
+    result = stream_gpt(
+        model=GPT_MODEL,
+        messages=[
+            {"role": "system", "content": STATIC_CATEGORY_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0
+    )
+    category = str(orjson.loads(result).get("category", "")).strip() or "Uncategorized"
+    _cache_put(path, category)
+    return category
+
+# Per-invoice session state, keyed by the uploaded file's SHA-256, so edits and
+# suggestions survive a page refresh. Held in process and mirrored to disk. The
+# store is shared by the whole process: anyone uploading the same PDF picks up
+# the last saved edits for it.
+PERSISTED_STATE_DEFAULTS = {
+    "extracted_data": {},
+    "invoice_text": "",
+    "suggested_category": "",
+    "journal_entries": [],
+    "category": ""
+}
+
+@st.cache_resource(show_spinner=False)
+def _session_store():
+    return {}
+
+def _session_path(file_hash):
+    return os.path.join(CACHE_DIR, f"session-{file_hash}.json")
+
+def save_invoice_state(file_hash):
+    if not file_hash:
+        return
+    state = {key: copy.deepcopy(st.session_state[key]) for key in PERSISTED_STATE_DEFAULTS if key in st.session_state}
+    # Table edits are kept apart from the editor's input (see journal_edits) but
+    # are what gets restored as the invoice's journal entries
+    if st.session_state.get("journal_edits") is not None:
+        state["journal_entries"] = copy.deepcopy(st.session_state["journal_edits"])
+    _session_store()[file_hash] = state
+    _write_cache(_session_path(file_hash), state)
+
+# Start a new upload from defaults so nothing carries over from the last invoice
+def reset_invoice_state():
+    for key, default in PERSISTED_STATE_DEFAULTS.items():
+        st.session_state[key] = copy.deepcopy(default)
+    st.session_state["invoice_hash"] = ""
+    clear_journal_edits()
+
+# Edits from the journal table live in journal_edits rather than being written
+# back into journal_entries: that list is the data_editor's input, and changing
+# it would make the editor replay its stored edits on top of them
+def clear_journal_edits():
+    st.session_state["journal_edits"] = None
+    st.session_state.pop("editable_journal_entries", None)
+
+def load_invoice_state(file_hash):
+    store = _session_store()
+    if file_hash not in store:
+        state = _read_cache(_session_path(file_hash))
+        if state is None:
+            return None
+        store[file_hash] = state
+    return copy.deepcopy(store[file_hash])
+
+# A failed extraction is remembered per file so reruns don't call GPT again
+def record_extraction_failure(file_hash, message):
+    st.session_state["failed_hash"] = file_hash
+    st.session_state["failure_message"] = message
+    st.error(message)
+
 # Streamlit page setup
 st.set_page_config(page_title="LedgerScribe", layout="wide")
 st.title("LedgerScribe: Invoice Parser & Journal Generator")
@@ -35,6 +600,16 @@ if "invoice_text" not in st.session_state:
     st.session_state["invoice_text"] = ""
 if "journal_entries" not in st.session_state:
     st.session_state["journal_entries"] = []
+if "suggested_category" not in st.session_state:
+    st.session_state["suggested_category"] = ""
+if "invoice_hash" not in st.session_state:
+    st.session_state["invoice_hash"] = ""
+if "journal_edits" not in st.session_state:
+    st.session_state["journal_edits"] = None
+if "failed_hash" not in st.session_state:
+    st.session_state["failed_hash"] = ""
+if "failure_message" not in st.session_state:
+    st.session_state["failure_message"] = ""
 
 # Tabs
 tabs = st.tabs(["Upload Invoice", "Journal Entries", "Ledger History", "Inventory", "Dashboard"])
@@ -44,58 +619,47 @@ with tabs[0]:
     st.header("Invoice Upload and Details")
 
     uploaded_file = st.file_uploader("Upload your Invoice PDF", type=["pdf"])
-    if uploaded_file:
-        text = ""
+    pdf_bytes = uploaded_file.getvalue() if uploaded_file else b""
+    file_hash = hashlib.sha256(pdf_bytes).hexdigest() if uploaded_file else ""
+
+    # Parse and extract once per upload; later reruns keep the user's edits
+    if uploaded_file and st.session_state["invoice_hash"] != file_hash:
+        reset_invoice_state()
+        saved_state = load_invoice_state(file_hash)
+        if saved_state:
+            st.session_state.update(saved_state)
+            st.session_state["invoice_hash"] = file_hash
+            st.session_state["failed_hash"] = ""
+            st.info("Restored saved details for this invoice.")
+
+    if uploaded_file and st.session_state["failed_hash"] == file_hash:
+        st.error(st.session_state["failure_message"])
+        if st.button("Retry extraction"):
+            st.session_state["failed_hash"] = ""
+            st.rerun()
+    elif uploaded_file and st.session_state["invoice_hash"] != file_hash:
         try:
-            with pdfplumber.open(uploaded_file) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
+            text = compact_invoice_text(extract_pdf_pages(pdf_bytes))
             st.session_state["invoice_text"] = text
 
             # Auto extract invoice fields on upload
             with st.spinner("Calling GPT to extract invoice fields..."):
-                prompt = f"""
-Extract the following fields from this invoice text:
-
-- invoice_number
-- invoice_date
-- vendor_name
-- line_items (list of description, quantity, and amount)
-- subtotal
-- taxes
-- total_amount
-- contact_info (address, phone_number)
-
-Only return a valid JSON object with those fields.
-
-Invoice:
-{text}
-"""
                 try:
-                    response = openai.ChatCompletion.create(
-                        model="gpt-4",
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0
-                    )
-                    result = response.choices[0].message["content"]
-                    data = json.loads(result)
-
-                    for item in data.get("line_items", []):
-                        amt = item.get("amount", "$0").replace("$", "").replace(",", "")
-                        item["amount"] = float(amt)
-                        item["quantity"] = int(item.get("quantity", 1))
-                        item["unit_cost"] = round(item["amount"] / item["quantity"], 2) if item["quantity"] != 0 else 0
-
-                    st.session_state["extracted_data"] = data
+                    extraction = gpt_extract(text)
+                    st.session_state["extracted_data"] = extraction["invoice"]
+                    st.session_state["suggested_category"] = extraction["category"]
+                    st.session_state["invoice_hash"] = file_hash
+                    save_invoice_state(file_hash)
                     st.success("Fields extracted.")
 
                 except Exception as e:
-                    st.error(f"GPT parsing error: {e}")
+                    if is_quota_error(e):
+                        record_extraction_failure(file_hash, "OpenAI quota exceeded. Check the plan and billing for your API key.")
+                    else:
+                        record_extraction_failure(file_hash, f"GPT parsing error: {e}")
 
         except Exception as e:
-            st.error(f"PDF Read Error: {e}")
+            record_extraction_failure(file_hash, f"PDF Read Error: {e}")
 
     data = st.session_state.get("extracted_data", {})
 
@@ -124,6 +688,7 @@ Invoice:
                     "unit_cost": round(item_amount / item_qty, 2) if item_qty > 0 else 0
                 })
                 st.session_state["extracted_data"] = data
+                save_invoice_state(st.session_state["invoice_hash"])
                 st.rerun()
 
         if data.get("line_items"):
@@ -137,6 +702,7 @@ Invoice:
                 if col5.button("❌", key=f"delete_{idx}"):
                     data["line_items"].pop(idx)
                     st.session_state["extracted_data"] = data
+                    save_invoice_state(st.session_state["invoice_hash"])
                     st.rerun()
 
         total_amount = sum(item["amount"] for item in data.get("line_items", []))
@@ -167,6 +733,7 @@ Invoice:
                 data["vendor_name"] = vendor_name
                 data["total_amount"] = total_amount
                 st.session_state["extracted_data"] = data
+                save_invoice_state(st.session_state["invoice_hash"])
                 st.success("Invoice details processed.")
     else:
         st.info("Please upload a valid invoice PDF.")
@@ -193,25 +760,28 @@ with tabs[1]:
             vendor = extracted_data.get("vendor_name", "").strip()
             category = VENDOR_CATEGORY_MAP.get(vendor)
 
+            if not category and st.session_state.get("suggested_category"):
+                category = st.session_state["suggested_category"]
+                st.info(f"GPT Suggested Category: {category}")
+
             if not category:
-                prompt = f"Suggest an accounting category like 'Office Supplies', 'IT Services', 'Inventory Purchases' for this invoice:\n{text}\nReturn just the category name."
                 try:
-                    response = openai.ChatCompletion.create(
-                        model="gpt-4",
-                        messages=[{"role": "user", "content": prompt}],
-                        temperature=0
-                    )
-                    category = response.choices[0].message["content"].strip()
+                    category = suggest_category(text)
                     st.info(f"GPT Suggested Category: {category}")
                 except Exception as e:
                     category = "Uncategorized"
-                    st.warning("GPT failed. Defaulted to 'Uncategorized'.")
+                    if is_quota_error(e):
+                        st.warning("OpenAI quota exceeded. Defaulted to 'Uncategorized'.")
+                    else:
+                        st.warning("GPT failed. Defaulted to 'Uncategorized'.")
 
             journal_entries = [
                 {"debit": category, "credit": "Accounts Payable", "amount": amount}
             ]
             st.session_state["journal_entries"] = journal_entries
             st.session_state["category"] = category
+            clear_journal_edits()
+            save_invoice_state(st.session_state["invoice_hash"])
             st.success("Suggested journal entries loaded.")
 
     # Editable Table
@@ -222,6 +792,22 @@ with tabs[1]:
         key="editable_journal_entries"
     )
 
+    # Persist table edits as they happen so a refresh doesn't revert them
+    journal_edits = [
+        {
+            "debit": entry.get("debit"),
+            "credit": entry.get("credit"),
+            "amount": None if entry.get("amount") in (None, "") else float(entry["amount"])
+        }
+        for entry in edited_entries
+    ]
+    previous = st.session_state.get("journal_edits")
+    if previous is None:
+        previous = st.session_state.get("journal_entries", [])
+    if journal_edits != previous:
+        st.session_state["journal_edits"] = journal_edits
+        save_invoice_state(st.session_state["invoice_hash"])
+
     if st.button("Confirm and Save to Ledger"):
         if not edited_entries:
             st.warning("No journal entries to save.")
@@ -230,46 +816,53 @@ with tabs[1]:
             date = data.get("invoice_date", "Enter invoice date")
             ref = data.get("invoice_number", "unknown")
 
-            if os.path.exists(LEDGER_FILE):
-                existing = pd.read_excel(LEDGER_FILE)
-                last_sr = existing["sr_no"].max() + 1
-            else:
-                existing = pd.DataFrame()
-                last_sr = 1
-
-            rows = []
-            sr = last_sr
-            for entry in edited_entries:
-                rows.append({"sr_no": sr, "date": date, "reference": ref, "description": entry["debit"], "debit": entry["amount"], "credit": None})
-                sr += 1
-                rows.append({"sr_no": sr, "date": date, "reference": ref, "description": entry["credit"], "debit": None, "credit": entry["amount"]})
-                sr += 1
-
-            new_df = pd.DataFrame(rows)
-            combined = pd.concat([existing, new_df], ignore_index=True)
-            combined.to_excel(LEDGER_FILE, index=False)
-            st.success("Ledger updated.")
+            # Each entry becomes a debit row followed by a credit row
+            n = len(edited_entries)
+            debit_descs = [entry["debit"] for entry in edited_entries]
+            credit_descs = [entry["credit"] for entry in edited_entries]
+            amounts = [entry["amount"] for entry in edited_entries]
+            blanks = [None] * n
+
+            saved = False
+            try:
+                append_ledger({
+                    "date": [date] * (2 * n),
+                    "reference": [ref] * (2 * n),
+                    "description": list(chain.from_iterable(zip(debit_descs, credit_descs))),
+                    "debit": list(chain.from_iterable(zip(amounts, blanks))),
+                    "credit": list(chain.from_iterable(zip(blanks, amounts)))
+                })
+                saved = True
+                st.success("Ledger updated.")
+            except (ValueError, TypeError) as e:
+                st.error(f"Ledger Save Error: {e}")
 
             # --- Inventory Sync ---
-            if st.session_state.get("category") == "Inventory Purchases":
-                inv_df = pd.read_excel(INVENTORY_FILE) if os.path.exists(INVENTORY_FILE) else pd.DataFrame(columns=["description", "quantity", "amount", "invoice_number", "invoice_date"])
-                for item in data.get("line_items", []):
-                    row = {
-                        "description": item.get("description"),
-                        "quantity": item.get("quantity"),
-                        "amount": item.get("amount"),
-                        "invoice_number": ref,
-                        "invoice_date": date
-                    }
-                    inv_df = pd.concat([inv_df, pd.DataFrame([row])], ignore_index=True)
-                inv_df.to_excel(INVENTORY_FILE, index=False)
+            if saved and st.session_state.get("category") == "Inventory Purchases":
+                inv_df = pd.read_excel(INVENTORY_FILE, engine=EXCEL_READ_ENGINE) if os.path.exists(INVENTORY_FILE) else pd.DataFrame(columns=["description", "quantity", "amount", "invoice_number", "invoice_date"])
+                items = data.get("line_items", [])
+                new_items = pd.DataFrame({
+                    "description": [item.get("description") for item in items],
+                    "quantity": [item.get("quantity") for item in items],
+                    "amount": [item.get("amount") for item in items],
+                    "invoice_number": [ref] * len(items),
+                    "invoice_date": [date] * len(items)
+                })
+                inv_df = pd.concat([inv_df, new_items], ignore_index=True)
+                inv_df.to_excel(INVENTORY_FILE, index=False, engine=EXCEL_WRITE_ENGINE)
 
 # Ledger History
 with tabs[2]:
     st.subheader("Ledger Entries")
-    if os.path.exists(LEDGER_FILE):
-        df = pd.read_excel(LEDGER_FILE)
+    df = load_ledger()
+    if df is not None:
         st.dataframe(df, use_container_width=True)
+        st.download_button(
+            "Download XLSX",
+            data=ledger_to_xlsx(df),
+            file_name="ledger.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
     else:
         st.info("No ledger entries found yet.")
 
@@ -277,7 +870,7 @@ with tabs[2]:
 with tabs[3]:
     st.header("Inventory")
     if os.path.exists(INVENTORY_FILE):
-        inv_df = pd.read_excel(INVENTORY_FILE)
+        inv_df = pd.read_excel(INVENTORY_FILE, engine=EXCEL_READ_ENGINE)
         inv_df["amount"] = inv_df["amount"].astype(str).str.replace("$", "").str.replace(",", "").astype(float)
         inv_df["quantity"] = pd.to_numeric(inv_df["quantity"], errors="coerce").fillna(0)
         inv_df["unit_cost"] = inv_df.apply(lambda row: row["amount"] / row["quantity"] if row["quantity"] != 0 else 0, axis=1)
@@ -299,8 +892,8 @@ with tabs[4]:
 
     col1, col2 = st.columns(2)
 
-    if os.path.exists(LEDGER_FILE):
-        ledger_df = pd.read_excel(LEDGER_FILE)
+    ledger_df = load_ledger()
+    if ledger_df is not None:
         total_debit = ledger_df["debit"].fillna(0).sum()
         total_credit = ledger_df["credit"].fillna(0).sum()
 
@@ -315,7 +908,7 @@ with tabs[4]:
         st.info("No ledger data available.")
 
     if os.path.exists(INVENTORY_FILE):
-        inv_df = pd.read_excel(INVENTORY_FILE)
+        inv_df = pd.read_excel(INVENTORY_FILE, engine=EXCEL_READ_ENGINE)
         inv_df["amount"] = inv_df["amount"].astype(str).str.replace("$", "").str.replace(",", "").astype(float)
         inv_df["quantity"] = pd.to_numeric(inv_df["quantity"], errors="coerce").fillna(0)
         inv_df["unit_cost"] = inv_df.apply(lambda row: row["amount"] / row["quantity"] if row["quantity"] != 0 else 0, axis=1)